@@ -1,22 +1,37 @@
 
-from dash import Dash, html, dcc, dash_table, Input, Output, callback, State, clientside_callback
+from dash import Dash, html, dcc, dash_table, Input, Output, callback, State, clientside_callback, ctx, Patch, MATCH, ALL
+from dash.exceptions import PreventUpdate
 from dash.dash_table.Format import Format
 import dash_daq as daq
-import plotly.express as px
+from flask import send_from_directory
+from flask_caching import Cache
+from python_calamine import CalamineWorkbook
+from plotly.colors import qualitative
 import plotly.graph_objects as go
+import plotly.io as pio
+import functools
+import hashlib
+import itertools
+import os
 import pathlib
+import shutil
+import tempfile
 import pandas as pd
-import textwrap
+import numpy as np
 
 
 app = Dash(
     __name__, 
-    title='Inflation Inequality'
+    title='Inflation Inequality',
+    compress=True  # Gzip responses with Flask-Compress, as figure JSON is highly compressible
     )
 
 # Declare server for deployment. Needed for Procfile.
 server = app.server
 
+# Encode figures and callback responses with orjson. Dash serializes responses through plotly.io.json
+pio.json.config.default_engine = 'orjson'
+
 # Load data
 def path(data_file: str):
     """
@@ -26,9 +41,71 @@ def path(data_file: str):
     DATA_PATH = PATH.joinpath("data").resolve()
     return DATA_PATH.joinpath(data_file)
 
-dfs = {}
-for i in range(1, 4):  # Loop through figures 1, 2, and 3
-    dfs[f'fig{i}'] = pd.read_excel(path('inflation_inequality.xlsx'), sheet_name=f'fig{i}', engine='openpyxl')
+# Columns holding repeated labels. All other columns except Date hold numbers
+categorical_columns = ['Country', 'Consumption category', 'Main category', 'COICOP']
+
+def _load_sheet(wb, name: str):
+    """
+    Read a worksheet into a DataFrame, using its first row as column headers.
+    """
+    rows = wb.get_sheet_by_name(name).to_python()
+    # Calamine returns empty cells as empty strings
+    return pd.DataFrame.from_records(rows[1:], columns=rows[0]).replace('', np.nan)
+
+def _set_dtypes(df):
+    """
+    Set column types explicitly, also for Parquet files written by earlier versions of the app.
+    """
+    # Store labels as categoricals in order of appearance, so that comparisons and groupbys work on integer codes.
+    # Numeric columns are cast to single-precision floats, which is ample for rates and shares and halves their size
+    for col in df.columns:
+        if col in categorical_columns:
+            df[col] = pd.Categorical(df[col], categories=df[col].dropna().unique())
+        elif col != 'Date':
+            df[col] = df[col].astype('float32')
+
+    return df
+
+def _write_parquet(df, fig: str):
+    """
+    Write the typed sheet of a figure to its Parquet file through a temporary file, so that readers never see a partly written file.
+    """
+    fd, tmp_path = tempfile.mkstemp(prefix=f'{fig}.', suffix='.tmp.parquet', dir=path(''))
+    os.close(fd)
+    try:
+        df.to_parquet(tmp_path, compression='zstd')
+        os.replace(tmp_path, path(f'{fig}.parquet'))
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def load_data(figs: list):
+    """
+    Load the data for each figure from Parquet files, converting them from the Excel workbook on first run
+    or when the workbook has been updated since.
+    """
+    workbook_mtime = path('inflation_inequality.xlsx').stat().st_mtime
+    if all(path(f'{fig}.parquet').exists() and path(f'{fig}.parquet').stat().st_mtime >= workbook_mtime for fig in figs):
+        # Rebuild from the workbook if a cached file cannot be read, e.g. one left truncated by an earlier version of the app
+        try:
+            return {fig: _set_dtypes(pd.read_parquet(path(f'{fig}.parquet'))) for fig in figs}
+        except (OSError, ValueError):
+            pass
+
+    # Open the workbook once with the Rust-based calamine reader, which parses cell values much faster than openpyxl
+    wb = CalamineWorkbook.from_path(str(path('inflation_inequality.xlsx')))
+    dfs = {fig: _set_dtypes(_load_sheet(wb, fig)) for fig in figs}
+
+    # Cache typed sheets as Parquet for subsequent starts, the workbook is kept for the download button
+    try:
+        for fig, df in dfs.items():
+            _write_parquet(df, fig)
+    except OSError:
+        pass
+
+    return dfs
+
+dfs = load_data(['fig1', 'fig2', 'fig3'])
 
 # Define global variables
 opacity = 0.9
@@ -37,6 +114,17 @@ captionsize = 12
 legendsize = 12
 labelsize = 10
 font_family = 'Arial, sans-serif'
+
+# Define trace styles and hover templates shared across figures.
+# Hover labels show the trace name, so that the templates do not depend on the country
+quantile_line = dict(width=2.5)
+total_line = dict(color='#696969', width=2, dash='dash')
+hicp_line = dict(color='#A9A9A9', width=2, dash='dot')
+difference_line = dict(color='#000000')
+marker_size = 7
+inflation_hovertemplate = '<b>%{fullData.name}</b><br>Date: %{x}<br>Inflation rate: %{y:.2f}<extra></extra>'
+effect_hovertemplate = '<b>%{fullData.name}</b><br>Date: %{x}<br>Effect on inflation inequality: %{y:.2f}<extra></extra>'
+price_growth_hovertemplate = '<b>%{customdata}</b><br>Difference in consumption share: %{x:.2f}<br>Average inflation in 2023: %{y:.2f}<extra></extra>'
 country_dict = {
     'AT':'Austria', 
     'BE':'Belgium',
@@ -45,7 +133,7 @@ country_dict = {
     'CZ':'Czechia',
     'DE':'Germany', 
     'DK':'Denmark', 
-    'EE':'Estonia ', 
+    'EE':'Estonia', 
     'EL':'Greece', 
     'ES':'Spain',
     'FI':'Finland',
@@ -67,6 +155,111 @@ country_dict = {
     'SK':'Slovakia'
     }
 
+# Columns not shown for each figure. Figure 3 shows only the latest years of average inflation and no COICOP
+excluded_columns = {
+    'fig1': ['Country'],
+    'fig2': ['Country'],
+    'fig3': [
+        'Country',
+        'COICOP',
+        'Average inflation in 2019', 
+        'Average inflation in 2020', 
+        'Average inflation in 2021', 
+        'Average inflation in 2022'
+    ]
+}
+
+def _country_data(country_df, fig: str):
+    """
+    Get the shown columns without missing values of a country's data, keeping only the categories present for that country.
+    """
+    data = country_df.drop(columns=excluded_columns[fig]).dropna(axis=1)
+    return data.assign(**{
+        col: data[col].cat.remove_unused_categories() for col in data.select_dtypes('category').columns
+        })
+
+# Pre-compute the data of each country for each figure with one groupby per sheet, so that callbacks only need a dict lookup
+dfs_by_country = {
+    fig: {
+        country: _country_data(country_df, fig)
+        for country, country_df in df.groupby('Country', sort=False, observed=True)
+    }
+    for fig, df in dfs.items()
+}
+
+def _arrays(data, columns: list):
+    """
+    Get columns of a DataFrame as a dict of NumPy arrays, with dates as milliseconds since epoch.
+    """
+    arrays = {col: data[col].to_numpy() for col in columns}
+    if 'Date' in arrays:
+        arrays['Date'] = pd.to_datetime(data['Date'], format='%Y-%m').to_numpy().astype('datetime64[ms]').astype('int64')
+    return arrays
+
+# Pre-compute the plotted columns of the time series figures as NumPy arrays.
+# The difference in Figure 2 is repeated for every category of a month, so only one row per month is kept.
+arrays_by_country = {
+    'fig1': {
+        country: _arrays(data, data.columns) 
+        for country, data in dfs_by_country['fig1'].items()
+    },
+    'fig2': {
+        country: _arrays(data.drop_duplicates('Date'), ['Date', 'Difference between inflation rates of bottom and top quantiles']) 
+        for country, data in dfs_by_country['fig2'].items()
+    }
+}
+
+def _category_arrays(df, category_col: str, columns: list):
+    """
+    Get the arrays of each category trace by country, grouping the whole sheet in one pass.
+    """
+    category_arrays = {}
+    for (country, category), category_data in df.groupby(['Country', category_col], sort=False, observed=True):
+        category_arrays.setdefault(country, {})[category] = _arrays(category_data, columns)
+    return category_arrays
+
+# Pre-compute the arrays of each category trace in Figures 2 and 3, in the order in which categories appear
+category_arrays_by_country = {
+    'fig2': _category_arrays(dfs['fig2'], 'Consumption category', ['Date', 'Effect on inflation inequality']),
+    'fig3': _category_arrays(dfs['fig3'], 'Main category', [
+        'Consumption category', 
+        'Difference in share of total expenditure', 
+        'Average inflation in 2023'
+    ])
+}
+
+def _mobile_dates(dates):
+    """
+    Get every second month of a time series, counting back from the latest month.
+    """
+    return np.unique(dates)[::-2]
+
+def _downsample(arrays: dict, dates):
+    """
+    Keep only the given months in a dict of arrays.
+    """
+    mask = np.isin(arrays['Date'], dates)
+    return {col: values[mask] for col, values in arrays.items()}
+
+# Dropdown options for country and figure selection
+# Only countries with data are offered, read from the categories of the Country column
+country_options = tuple(
+    {'label': country_dict[country], 'value': country} 
+    for country in sorted(dfs['fig1']['Country'].cat.categories) if country in country_dict
+)
+default_country = country_options[0]['value']
+figure_options = (
+    {'label': 'Figure 1: Inflation rate for top and bottom quantile', 'value': 'fig1'},
+    {'label': 'Figure 2: Expenditure categories driving inflation inequality', 'value': 'fig2'},
+    {'label': 'Figure 3: Price growth and difference in importance of consumption categories', 'value': 'fig3'}
+)
+
+# Colors of consumption categories in Figures 2 and 3, so that each category has the same color across countries and figures
+category_colors = dict(zip(
+    dfs['fig2']['Consumption category'].cat.categories,
+    itertools.cycle(qualitative.Plotly)
+    ))
+
 # Intro text for the app
 app_intro_text = """
     This website explores consumption-based inflation inequality in the EU to shed light on how different income groups 
@@ -130,8 +323,8 @@ app.layout = html.Div([
         # Dropdown for country selection
         dcc.Dropdown(
             id='country-dropdown',
-            options=[{'label': country_dict[country], 'value': country} for country in country_dict.keys()],
-            value='AT', # Default selected country
+            options=country_options,
+            value=default_country, # Default selected country
             multi=True,
             style={'font-family': font_family}  # Set font for dropdown options
         ),
@@ -139,11 +332,7 @@ app.layout = html.Div([
         # Dropdown for figure selection
         dcc.Dropdown(
             id='figure-dropdown',
-            options=[
-                {'label': 'Figure 1: Inflation rate for top and bottom quantile', 'value': 'fig1'},
-                {'label': 'Figure 2: Expenditure categories driving inflation inequality', 'value': 'fig2'},
-                {'label': 'Figure 3: Price growth and difference in importance of consumption categories', 'value': 'fig3'}
-            ],
+            options=figure_options,
             value='fig1',  # Default selected figure
             multi=False,
             style={
@@ -152,28 +341,41 @@ app.layout = html.Div([
             } 
         ),
         
-        # Button to download the data table
-        html.Button(
+        # Button to download the data table, served directly by the download route
+        html.A(
             'Download dataset', 
             id='btn_download',
+            href=app.get_relative_path('/download'),  # Respect the path prefix of the app
+            download='inflation_inequality.xlsx',
             className='button',
             style={
                 'font-family': font_family,
-                'margin-top': '5px'
+                'margin-top': '5px',
+                'display': 'inline-block',
+                'text-decoration': 'none'
             },
         ),
-        dcc.Download(id='download'),
 
         # Boolean switches container
         boolean_switches_div,
 
-        # Div to hold the selected figure
-        html.Div(id='selected-figure'),
+        # Div to hold the title, figure and table placeholders of each selected country
+        html.Div(id='selected-figure', children=[]),
+
+        # Div to hold the description of the selected figure
+        html.Div(id='figure-description'),
 
         # Store for detecting mobile devices
         dcc.Store(id='is-mobile-store', data=False),
     ])
 
+# Titles for each figure
+figure_titles = {
+    'fig1': 'Figure 1: Inflation rate for top and bottom {quantile}',
+    'fig2': 'Figure 2: Expenditure categories driving inflation inequality',
+    'fig3': 'Figure 3: Price growth and difference in importance of consumption categories'
+}
+
 # Text descriptions for each figure
 figure_descriptions = {
     'fig1': """   
@@ -215,15 +417,17 @@ figure_descriptions = {
     """
 }
 
+# Description components for each figure, built once and reused by the description callback
+figure_description_components = {
+    fig: html.P(description, style={'font-family': font_family}) for fig, description in figure_descriptions.items()
+}
 
-# Callback for data download button
-@callback(
-    Output('download', 'data'),
-    Input('btn_download', 'n_clicks'),
-    prevent_initial_call=True,
-)
-def func(n_clicks):
-    return dcc.send_file(path('inflation_inequality.xlsx'))
+
+# Route for data download button. Conditional responses allow range requests and 304 responses for repeat downloads
+@server.route(f'{app.config.routes_pathname_prefix}download')
+def download():
+    data_file = path('inflation_inequality.xlsx')
+    return send_from_directory(data_file.parent, data_file.name, as_attachment=True, conditional=True)
 
 
 # Clientside callback for detecting mobile devices
@@ -239,315 +443,461 @@ clientside_callback(
     prevent_initial_call=False
 )
 
-# Callback to update the selected figure based on dropdown values
-@callback(
-    Output('selected-figure', 'children'),
-    [Input('country-dropdown', 'value'),
-     Input('figure-dropdown', 'value'),
-     Input('table-switch', 'on'),
-     Input('legend-switch', 'on'),
-     Input('is-mobile-store', 'data')]
-)
-def update_selected_data(selected_countries, selected_figure, show_table, show_legend, is_mobile):
-
-    # Initiate list to hold figures
-    figures = []
+def _quantile(selected_country):
+    """
+    Get the income quantile used for a country.
+    """
+    if selected_country == 'BE':
+        return 'quartile'
+    else:
+        return 'quintile'
 
-    # If only one country selected, turn into list
-    if isinstance(selected_countries, str):
-        selected_countries = [selected_countries]
+def _title_text(selected_country, selected_figure, fig_letter=''):
+    """
+    Get the title of a country's figure, lettered when multiple countries are selected.
+    """
+    title_text = figure_titles[selected_figure].format(quantile=_quantile(selected_country))
     
-    # Loop through selected countries
-    for i, selected_country in enumerate(selected_countries):
-        
-        # Select df based on selected figure and country
-        selected_data = dfs[selected_figure].loc[dfs[selected_figure]['Country'] == selected_country].drop(columns='Country').dropna(axis=1)
-        
-        # If selected figure is Figure 3, show only Average inflation in 2023 and drop COICOP
-        if selected_figure == 'fig3':
-            selected_data = selected_data.drop(columns=[
-                'COICOP',
-                'Average inflation in 2019', 
-                'Average inflation in 2020', 
-                'Average inflation in 2021', 
-                'Average inflation in 2022'
-            ])
-        
-        # Define country-dependent variables
-        if selected_country == 'BE':
-            quantile = 'quartile'
-        else:
-            quantile = 'quintile'
-        
-        # Create table with selected data if switch is on
-        if show_table:
-            table = dash_table.DataTable(
-                id='table',
-                columns=[{
-                        'name': col, 
-                        'id': col, 
-                        'type': 'numeric', 
-                        'format': Format(precision=3)
-                        } for col in selected_data.columns
-                    ],
-                # selected_data without Country column
-                data=selected_data.to_dict('records'),
-                fixed_rows={'headers': True},
-                page_action='none',
-                sort_action='native',
-                sort_mode='multi',
-                style_header={
-                    'whiteSpace': 'normal',
-                    'height': 'auto',
-                    'minWidth': '90px', 
-                    'width': '90px', 
-                    'maxWidth': '90px',
-                    'textAlign': 'center'
-                    },
-                style_data={
-                    'whiteSpace': 'normal',
-                    'height': 'auto',
-                    'minWidth': '90px', 
-                    'width': '90px', 
-                    'maxWidth': '90px',
-                    'textAlign': 'left'
-                    },
-                style_table={
-                    'font-family': font_family, 
-                    'height': '300px', 
-                    'overflowY': 'auto'},
-                style_cell={'font-family': font_family}  # Set font for cells
-            ) 
-        else:
-            table = None  # Display table only if switch is on
-
-        # Retrieve the selected country's data for the chosen figure
-        if selected_figure == 'fig1':
-
-            title_text=f'Figure 1: Inflation rate for top and bottom {quantile} - {country_dict[selected_country]}'
-
-            fig = px.line(
-                selected_data[['Date', f'Top {quantile}', f'Bottom {quantile}']].melt(id_vars='Date'),
-                x='Date',
-                y='value',
-                template='plotly_white',
-                color='variable',
-                markers=False,
-                custom_data=selected_data[['Date', f'Bottom {quantile}', f'Top {quantile}']].melt(id_vars='Date')
-            )
+    # Insert letter to title text after 8th character
+    return f'{title_text[:8]}{fig_letter}{title_text[8:]} - {country_dict[selected_country]}'
+
+# Define layout options shared across figures
+base_layout = dict(
+    dragmode=False,
+    font_family=font_family,
+    font_color= '#000000',
+    margin={
+        't':20,
+        'b':20,
+        'l':5, 
+        'r':40,
+    },
+    legend=dict(
+        itemsizing='trace'
+    ),
+    legend_title_text=None,
+    )
 
-            fig.update_traces(
-                hovertemplate='<b>%{customdata[1]}</b><br>Date: %{x}<br>Inflation rate: %{y:.2f}<extra></extra>',
-                line=dict(width=2.5),
-                opacity=opacity
-            )
+# Define layout options for mobile devices, with zero side margins and a horizontal legend below the plot
+mobile_layout = dict(
+    margin={
+        'l':0, 
+        'r':0
+        },
+    legend=dict(
+        orientation='h',
+        yanchor='top',
+        y=-0.25,
+        xanchor='center',
+        x=0.5
+        )
+    )
 
-            fig.add_trace(
-                go.Scatter(
-                    x=selected_data[['Date', 'Total']].melt(id_vars='Date')['Date'],
-                    y=selected_data[['Date', 'Total']].melt(id_vars='Date')['value'],
-                    line=dict(
-                        color='#696969',
-                        width=2,
-                        dash='dash'
-                    ),
-                    opacity=opacity,
-                    name="Total",
-                    customdata=selected_data[['Date', 'Total']].melt(id_vars='Date'),
-                    hovertemplate='<b>Total</b><br>Date: %{x}<br>Inflation rate: %{y:.2f}<extra></extra>',
-                )
-            )
+def _update_layout(fig, is_mobile, time_series=True):
+    """
+    Set the layout options shared across figures and return the figure as a JSON-ready dict.
+    """
+    fig.update_layout(base_layout)
 
-            fig.add_trace(
-                go.Scatter(
-                    x=selected_data[['Date', 'HICP']].melt(id_vars='Date')['Date'],
-                    y=selected_data[['Date', 'HICP']].melt(id_vars='Date')['value'],
-                    line=dict(
-                        color='#A9A9A9',
-                        width=2,
-                        dash='dot'
-                    ),
-                    opacity=opacity,
-                    name="HICP",
-                    customdata=selected_data[['Date', 'HICP']].melt(id_vars='Date'),
-                    hovertemplate='<b>HICP</b><br>Date: %{x}<br>Inflation rate: %{y:.2f}<extra></extra>',
-                )
-            )
+    if is_mobile:
+        fig.update_layout(mobile_layout)
 
+        # Set x-axis ticks to every six months and move the legend up for fig 1 and 2
+        if time_series:
             fig.update_xaxes(
-                title_text=None,
-                dtick="M3",
-                tickformat='%b\n%Y',
-                automargin=True
-            )
-            
-            fig.update_yaxes(
-                title_text='Inflation rate (yoy)',
-                automargin=True
-            ) 
-
-        elif selected_figure == 'fig2':
-            
-            title_text=f'Figure 2: Expenditure categories driving inflation inequality - {country_dict[selected_country]}'
-
-            fig = px.bar(
-                selected_data,
-                x='Date',
-                y='Effect on inflation inequality',
-                template='plotly_white',
-                color='Consumption category',
-                opacity=opacity,
-                custom_data= selected_data
-                )
-
-            fig.update_traces(
-                hovertemplate='<b>%{customdata[1]}</b><br>Date: %{x}<br>Effect on inflation inequality: %{y:.2f}<extra></extra>',
+                dtick="M6"
                 )
-            
-            if quantile == 'quintile':
-                fig.add_trace(
-                    go.Scatter(
-                        x= selected_data['Date'],
-                        y= selected_data['Difference between inflation rates of bottom and top quantiles'],
-                        line=dict(color='#000000'),
-                        name=f'Difference between inflation rates<br>of bottom and top {quantile}s',
-                        customdata= selected_data,
-                        opacity=opacity,
-                        hovertemplate='<b>Difference between inflation rates of bottom and top quintiles</b><br>%{x}: %{y:.2f}<extra></extra>'
-                        )
-                    )  
-
-            elif quantile == 'quartile':
-                fig.add_trace(
-                    go.Scatter(
-                        x= selected_data['Date'],
-                        y= selected_data['Difference between inflation rates of bottom and top quantiles'],
-                        line=dict(color='#000000'),
-                        name=f'Difference between inflation rates<br>of bottom and top {quantile}s',
-                        customdata= selected_data,
-                        opacity=opacity,
-                        hovertemplate='<b>Difference between inflation rates of bottom and top quartiles</b><br>%{x}: %{y:.2f}<extra></extra>'
-                        )
-                    )   
-                
-            fig.update_xaxes(
-                title_text=None,
-                dtick="M3",
-                tickformat='%b\n%Y',
-                automargin=True
+            fig.update_layout(
+                legend_y=-0.15
                 )
-            
-            fig.update_yaxes(
-                title_text=None,
-                automargin=True
-                ) 
 
-        elif selected_figure == 'fig3':
-            title_text = f'Figure 3: Price growth and difference in importance of consumption categories - {country_dict[selected_country]}'
+    return fig.to_plotly_json()
+
+# Version the figure cache by the app code and the workbook, so that figures cached by previous versions are never served.
+# Workers of the same version share the cache directory, which is therefore never cleared at startup
+cache_version = hashlib.sha1(
+    pathlib.Path(__file__).read_bytes() + path('inflation_inequality.xlsx').read_bytes()
+    ).hexdigest()[:12]
+cache_dir = pathlib.Path(tempfile.gettempdir()).joinpath(f'inflation-inequality-cache-{cache_version}')
+
+# Remove the figure caches of other versions, which would otherwise pile up in the temporary directory
+for stale_dir in cache_dir.parent.glob('inflation-inequality-cache*'):
+    if stale_dir != cache_dir:
+        shutil.rmtree(stale_dir, ignore_errors=True)
+
+# Cache the JSON of each country's figures on disk, so that it is shared between workers.
+# The number of possible input combinations is small. For deployments across machines, use a RedisCache instead
+cache = Cache(app.server, config={
+    'CACHE_TYPE': 'FileSystemCache',
+    'CACHE_DIR': str(cache_dir),
+    'CACHE_DEFAULT_TIMEOUT': 3600
+    })
+
+@cache.memoize()
+def _build_fig1(selected_country, is_mobile):
+    """
+    Build Figure 1 of a single country.
+    """
+    quantile = _quantile(selected_country)
+    arrays = arrays_by_country['fig1'][selected_country]
 
-            fig = px.scatter(
-                selected_data, 
-                x='Difference in share of total expenditure', 
-                y='Average inflation in 2023', 
-                template='plotly_white',
-                color='Main category',
-                opacity=opacity,
-                custom_data=selected_data
-                )
-            
-            fig.update_traces(
-                marker=dict(size=7),
-                selector=dict(mode='markers'),
-                hovertemplate='<b>%{customdata[1]}</b><br>Difference in consumption share: %{x:.2f}<br>Average inflation in 2023: %{y:.2f}<extra></extra>',
-                line=dict(width=2.5),
-                opacity=opacity
-                )
+    # Plot every second month on mobile devices
+    if is_mobile:
+        arrays = _downsample(arrays, _mobile_dates(arrays['Date']))
 
-            fig.update_xaxes(
-                zeroline=True, 
-                zerolinewidth=1,
-                zerolinecolor='grey',
-                automargin=True
-                )
+    dates = arrays['Date']
 
-            fig.update_yaxes(
-                zeroline=True, 
-                zerolinewidth=1,
-                zerolinecolor='grey',
-                automargin=True
-                )
-        
-        # Update title text according to selected country
-        if len(selected_countries) > 1:
-            # insert letter to title text atfer 8th character
-            fig_letter = chr(97 + i)
-            title_text = title_text[:8]+fig_letter+title_text[8:]
-
-        # Set common layout options across figures
-        fig.update_layout(
-            dragmode=False,
-            font_family=font_family,
-            font_color= '#000000',
-            margin={
-                't':20,
-                'b':20,
-                'l':5, 
-                'r':40,
-            },
-            legend=dict(
-                itemsizing='trace'
+    fig = go.Figure(
+        data=[
+            go.Scatter(
+                x=dates,
+                y=arrays[f'Top {quantile}'],
+                line=quantile_line,
+                opacity=opacity,
+                name=f'Top {quantile}',
+                hovertemplate=inflation_hovertemplate,
+            ),
+            go.Scatter(
+                x=dates,
+                y=arrays[f'Bottom {quantile}'],
+                line=quantile_line,
+                opacity=opacity,
+                name=f'Bottom {quantile}',
+                hovertemplate=inflation_hovertemplate,
             ),
-            legend_title_text=None,
-            showlegend=show_legend,
+            go.Scatter(
+                x=dates,
+                y=arrays['Total'],
+                line=total_line,
+                opacity=opacity,
+                name="Total",
+                hovertemplate=inflation_hovertemplate,
+            ),
+            go.Scatter(
+                x=dates,
+                y=arrays['HICP'],
+                line=hicp_line,
+                opacity=opacity,
+                name="HICP",
+                hovertemplate=inflation_hovertemplate,
+            ),
+        ],
+        layout=dict(template='plotly_white')
+    )
+
+    fig.update_xaxes(
+        type='date',  # Dates are passed as milliseconds since epoch
+        title_text=None,
+        dtick="M3",
+        tickformat='%b\n%Y',
+        automargin=True
+    )
+    
+    fig.update_yaxes(
+        title_text='Inflation rate (yoy)',
+        automargin=True
+    )
+
+    return _update_layout(fig, is_mobile)
+
+@cache.memoize()
+def _build_fig2(selected_country, is_mobile):
+    """
+    Build Figure 2 of a single country.
+    """
+    quantile = _quantile(selected_country)
+    arrays = arrays_by_country['fig2'][selected_country]
+    category_arrays = category_arrays_by_country['fig2'][selected_country]
+
+    # Plot every second month on mobile devices
+    if is_mobile:
+        mobile_dates = _mobile_dates(arrays['Date'])
+        arrays = _downsample(arrays, mobile_dates)
+        category_arrays = {
+            category: _downsample(values, mobile_dates) for category, values in category_arrays.items()
+            }
+
+    # Add one bar trace per consumption category, keeping the order in which categories appear
+    fig = go.Figure(
+        data=[
+            go.Bar(
+                x=values['Date'],
+                y=values['Effect on inflation inequality'],
+                name=category,
+                marker_color=category_colors[category],
+                opacity=opacity,
+                hovertemplate=effect_hovertemplate,
+                ) 
+            for category, values in category_arrays.items()
+            ],
+        layout=dict(
+            template='plotly_white',
+            barmode='relative'
             )
+        )
+    
+    fig.add_trace(
+        go.Scatter(
+            x=arrays['Date'],
+            y=arrays['Difference between inflation rates of bottom and top quantiles'],
+            line=difference_line,
+            name=f'Difference between inflation rates<br>of bottom and top {quantile}s',
+            opacity=opacity,
+            hovertemplate=f'<b>Difference between inflation rates of bottom and top {quantile}s</b><br>%{{x}}: %{{y:.2f}}<extra></extra>'
+            )
+        )
+        
+    fig.update_xaxes(
+        type='date',  # Dates are passed as milliseconds since epoch
+        title_text=None,
+        dtick="M3",
+        tickformat='%b\n%Y',
+        automargin=True
+        )
+    
+    fig.update_yaxes(
+        title_text=None,
+        automargin=True
+        )
 
-        # Set layout options for mobile devices
-        if is_mobile:
-            # Set margins to zero
-            fig.update_layout(
-                margin={
-                    'l':0, 
-                    'r':0
-                    },
-                legend=dict(
-                    itemsizing='trace',
-                    orientation='h',
-                    yanchor='top',
-                    y=-0.25,
-                    xanchor='center',
-                    x=0.5
-                    )
+    return _update_layout(fig, is_mobile)
+
+@cache.memoize()
+def _build_fig3(selected_country, is_mobile):
+    """
+    Build Figure 3 of a single country.
+    """
+    category_arrays = category_arrays_by_country['fig3'][selected_country]
+
+    # Add one marker trace per main category, with the same colors as the categories in Figure 2.
+    # Markers are drawn as SVG, since every WebGL graph opens its own WebGL context and browsers limit their number per page
+    fig = go.Figure(
+        data=[
+            go.Scatter(
+                x=values['Difference in share of total expenditure'],
+                y=values['Average inflation in 2023'],
+                mode='markers',
+                marker=dict(
+                    color=category_colors[category],
+                    size=marker_size
+                    ),
+                opacity=opacity,
+                name=category,
+                customdata=values['Consumption category'],
+                hovertemplate=price_growth_hovertemplate,
                 )
+            for category, values in category_arrays.items()
+            ],
+        layout=dict(template='plotly_white')
+        )
+
+    fig.update_xaxes(
+        title_text='Difference in share of total expenditure',
+        zeroline=True, 
+        zerolinewidth=1,
+        zerolinecolor='grey',
+        automargin=True
+        )
+
+    fig.update_yaxes(
+        title_text='Average inflation in 2023',
+        zeroline=True, 
+        zerolinewidth=1,
+        zerolinecolor='grey',
+        automargin=True
+        )
+
+    return _update_layout(fig, is_mobile, time_series=False)
+
+# Keep all figures in memory once built, to skip reading them from the disk cache.
+# The cache is unbounded, as there are only 27 countries x 3 figures x 2 devices = 162 combinations
+@functools.lru_cache(maxsize=None)
+def _build_figure(selected_country, selected_figure, is_mobile):
+    """
+    Build the figure of a single country as a JSON-ready dict, which is shared between calls and must not be modified.
+    """
+    if selected_figure == 'fig1':
+        return _build_fig1(selected_country, is_mobile)
+    elif selected_figure == 'fig2':
+        return _build_fig2(selected_country, is_mobile)
+    elif selected_figure == 'fig3':
+        return _build_fig3(selected_country, is_mobile)
+
+# Build the figures of the default selection at startup, so that the first page load does not wait for them
+for is_mobile in (False, True):
+    _build_figure(default_country, 'fig1', is_mobile)
+
+# Pre-compute the table records of each country for each figure, as they do not depend on the table switch or device
+table_records = {
+    fig: {country: data.to_dict('records') for country, data in by_country.items()}
+    for fig, by_country in dfs_by_country.items()
+}
 
-            # Set legend position and x-axis tick format to month and year for fig 1 and 2
-            if selected_figure != 'fig3':
-                fig.update_xaxes(
-                    dtick="M6"
-                    )
-                fig.update_layout(
-                    margin={
-                        'l':0, 
-                        'r':0
-                        },
-                    legend=dict(
-                        y=-0.15,
-                        )
-                    )
-        
-        # Add figure to the list
-        figures.extend([
-            html.H3(title_text,
+# Number format shared by all numeric table columns
+numeric_format = Format(precision=3)
+
+def _table_column(data, col):
+    """
+    Get the column spec of the data table, formatting only numeric columns as numbers.
+    """
+    if pd.api.types.is_numeric_dtype(data[col]):
+        return {'name': col, 'id': col, 'type': 'numeric', 'format': numeric_format}
+    return {'name': col, 'id': col}
+
+# Pre-compute the table column specs of each country for each figure
+table_columns = {
+    fig: {
+        country: [_table_column(data, col) for col in data.columns]
+        for country, data in by_country.items()
+    }
+    for fig, by_country in dfs_by_country.items()
+}
+
+# Define data table styles shared across tables
+table_header_style = {
+    'whiteSpace': 'normal',
+    'height': 'auto',
+    'minWidth': '90px', 
+    'width': '90px', 
+    'maxWidth': '90px',
+    'textAlign': 'center'
+    }
+table_data_style = {**table_header_style, 'textAlign': 'left'}
+table_style = {
+    'font-family': font_family, 
+    'height': '300px', 
+    'overflowY': 'auto'
+    }
+table_cell_style = {'font-family': font_family}  # Set font for cells
+
+def _build_table(columns, table_data):
+    """
+    Build the data table component from a list of records.
+    """
+    return dash_table.DataTable(
+        columns=columns,
+        # Records of selected data without Country column
+        data=table_data,
+        fixed_rows={'headers': True},
+        page_action='none',
+        virtualization=True,  # Render only the rows visible in the scrollable table
+        sort_action='native',
+        sort_mode='multi',
+        style_header=table_header_style,
+        style_data=table_data_style,
+        style_table=table_style,
+        style_cell=table_cell_style
+    ) 
+
+def _country_placeholder(selected_country):
+    """
+    Create the placeholders for the title, figure and table of a country.
+    """
+    return html.Div(
+        [
+            html.H3(id={'type': 'country-title', 'country': selected_country},
                     style={'font-family': font_family}),
-            dcc.Graph(
-                id=f'figure-{selected_country}',
-                figure=fig
-            ),
-            table
-        ])
+            dcc.Graph(id={'type': 'country-figure', 'country': selected_country}),
+            html.Div(id={'type': 'country-table', 'country': selected_country})
+        ],
+        id={'type': 'country-block', 'country': selected_country}
+    )
+
+# Callback to add and remove the placeholders of selected countries
+@callback(
+    Output('selected-figure', 'children'),
+    Input('country-dropdown', 'value'),
+    State({'type': 'country-block', 'country': ALL}, 'id')
+)
+def update_selected_countries(selected_countries, block_ids):
+
+    # If only one country selected, turn into list
+    if isinstance(selected_countries, str):
+        selected_countries = [selected_countries]
+    selected_countries = selected_countries or []
+    mounted_countries = [block_id['country'] for block_id in block_ids]
+
+    # Only remove deselected and append newly selected countries, so that the graphs of other countries stay mounted
+    placeholders = Patch()
+    for index in reversed(range(len(mounted_countries))):
+        if mounted_countries[index] not in selected_countries:
+            del placeholders[index]
+    for selected_country in selected_countries:
+        if selected_country not in mounted_countries:
+            placeholders.append(_country_placeholder(selected_country))
 
-    return figures + [html.Div([
-                html.P(figure_descriptions[selected_figure], style={'font-family': font_family})
-            ])]
+    return placeholders
+
+# Callback to update the title of a country's figure
+@callback(
+    Output({'type': 'country-title', 'country': MATCH}, 'children'),
+    Input('figure-dropdown', 'value'),
+    Input('country-dropdown', 'value'),
+    State({'type': 'country-title', 'country': MATCH}, 'id')
+)
+def update_country_title(selected_figure, selected_countries, title_id):
+    if isinstance(selected_countries, str):
+        selected_countries = [selected_countries]
+    selected_country = title_id['country']
+
+    # Skip titles of countries that are being removed
+    if selected_country not in (selected_countries or []):
+        raise PreventUpdate
+
+    # Add letter to title if multiple countries are selected
+    if len(selected_countries) > 1:
+        fig_letter = chr(97 + selected_countries.index(selected_country))
+    else:
+        fig_letter = ''
+
+    return _title_text(selected_country, selected_figure, fig_letter)
+
+# Callback to update the figure of a country
+@callback(
+    Output({'type': 'country-figure', 'country': MATCH}, 'figure'),
+    Input('figure-dropdown', 'value'),
+    Input('legend-switch', 'on'),
+    Input('is-mobile-store', 'data'),
+    State({'type': 'country-figure', 'country': MATCH}, 'id')
+)
+def update_country_figure(selected_figure, show_legend, is_mobile, figure_id):
+
+    # Only patch the legend of the mounted figure if the legend switch is toggled
+    if ctx.triggered_id == 'legend-switch':
+        figure = Patch()
+        figure['layout']['showlegend'] = show_legend
+        return figure
+
+    figure = _build_figure(figure_id['country'], selected_figure, is_mobile)
+
+    # Copy the cached figure's top level before setting the legend
+    return {**figure, 'layout': {**figure['layout'], 'showlegend': show_legend}}
+
+# Callback to update the data table of a country
+@callback(
+    Output({'type': 'country-table', 'country': MATCH}, 'children'),
+    Input('figure-dropdown', 'value'),
+    Input('table-switch', 'on'),
+    State({'type': 'country-table', 'country': MATCH}, 'id')
+)
+def update_country_table(selected_figure, show_table, table_id):
+
+    # Display table only if switch is on. Other inputs leave a hidden table untouched
+    if not show_table:
+        if ctx.triggered_id == 'table-switch':
+            return None
+        raise PreventUpdate
+
+    return _build_table(table_columns[selected_figure][table_id['country']],
+                        table_records[selected_figure][table_id['country']])
+
+# Callback to update the description of the selected figure
+@callback(
+    Output('figure-description', 'children'),
+    Input('figure-dropdown', 'value')
+)
+def update_figure_description(selected_figure):
+    return figure_description_components[selected_figure]
 
 if __name__ == '__main__':
     app.run_server(debug=True)